@@ -1,13 +1,24 @@
+import hashlib
 import math
 import os
+import queue
 import re
 import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
 from functools import lru_cache
 
+import httpx
 import numpy as np
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
-import requests
+import orjson
+import torch
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from sentence_transformers import SentenceTransformer
 
 
@@ -15,51 +26,170 @@ from sentence_transformers import SentenceTransformer
 # config
 # =============================================================================
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """startup: model + OpenSearch client. shutdown: close the client"""
+    load_model()
+    open_http_client()
+    yield
+    await close_http_client()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+class _SkipHealthAccessLog(logging.Filter):
+    """drop uvicorn access-log lines for /health. the k8s probes hit it every few seconds and it just buries real traffic"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        args = record.args
+        return not (isinstance(args, tuple) and len(args) >= 3 and args[2] == "/health")
+
+
+logging.getLogger("uvicorn.access").addFilter(_SkipHealthAccessLog())
+
 OPENSEARCH_URL = os.getenv("OPENSEARCH_URL", "http://localhost:9200")
 INDEX_NAME = os.getenv("INDEX_NAME", "products")
+# the search page is a plain file next to this module, served as-is (browser caches it for a few minutes)
+INDEX_HTML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "index.html")
+# keep-alive pool to OpenSearch, per worker. in-flight requests past max_connections queue for a free connection
+OPENSEARCH_MAX_CONNECTIONS = int(os.getenv("OPENSEARCH_MAX_CONNECTIONS", "100"))
+OPENSEARCH_MAX_KEEPALIVE = int(os.getenv("OPENSEARCH_MAX_KEEPALIVE", "50"))
+
+# HYBRID_SEARCH=1: let OpenSearch fuse knn + title match (hybrid query through the search pipeline ingest creates)
+# and skip the Python re-rank. falls back to the re-rank if the pipeline/plugin isn't there
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "0") == "1"
+HYBRID_PIPELINE = os.getenv("HYBRID_PIPELINE", "hybrid-search")
 
 # RRF: how much to smooth the two rank lists. 60 is a sane default.
 RRF_K = 60
 # how many neighbors to consider when searching the vector index. bump up if you want better recall and don't mind slower
 KNN_EF_SEARCH = 200
 
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+# PyTorch path: TORCH_INT8=1 dynamically quantizes the Linear layers (most of MiniLM's compute) to int8. off by default:
+# doc vectors come from the fp32 model at ingest, and unlike the ONNX path nothing checks the int8 drift here
+TORCH_INT8 = os.getenv("TORCH_INT8", "0") == "1"
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", str(os.cpu_count() or 1)))
+# USE_ONNX=1 swaps the PyTorch model for an int8-quantized ONNX export run by ONNX Runtime (see README). unset = PyTorch fp32
+USE_ONNX = os.getenv("USE_ONNX", "0") == "1"
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx")
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "model_int8.onnx")
+ONNX_NUM_THREADS = int(os.getenv("ONNX_NUM_THREADS", str(os.cpu_count() or 1)))
+# exported int8 model has to stay this close (cosine) to the fp32 export on these queries before we use it
+ONNX_INT8_MIN_COSINE = 0.99
+ONNX_INT8_CHECK_QUERIES = [
+    "black leather jacket for men", "summer floral dress", "running shoes", "minimal crossbody bag",
+    "oversized wool sweater", "kids rain boots", "silver hoop earrings", "slim fit chinos",
+]
+# MiniLM's max_seq_length; anything longer gets cut the same way SentenceTransformer does it
+ONNX_MAX_SEQ_LEN = 256
+# query embeddings kept in memory; queries are heavily repeated so a few thousand covers most traffic
+EMBED_CACHE_SIZE = 4096
+EMBED_BATCH_SIZE = 32
+# cache misses from concurrent requests get encoded together. the batcher never waits for a lone request by default;
+# whatever queues up while a batch is running goes in the next one. set >0 to hold the first request a few ms for company
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "0"))
+# optional on-disk second tier for query embeddings so restarts/redeploys don't start cold. empty = in-memory only
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "")
+EMBED_CACHE_TTL_S = 30 * 24 * 3600
+
 # wrap the query in this so the embedding sits in the same "product description" space as the docs (ingest uses the same prefix)
 QUERY_CONTEXT_PREFIX = "Clothing, fashion product or accessory: "
 QUERY_CONTEXT_SUFFIX = ""
 
-STOPWORDS = {
+STOPWORDS = frozenset({
     "the", "a", "an", "of", "for", "and", "to", "in", "on", "with",
-}
+})
 
 # so "men" doesn't surface women's stuff and vice versa
-GENDER_MALE_TERMS = {"men", "mens", "man", "male", "boys", "boy"}
-GENDER_FEMALE_TERMS = {"women", "womens", "woman", "female", "girls", "girl", "ladies", "lady"}
+GENDER_MALE_TERMS = frozenset({"men", "mens", "man", "male", "boys", "boy"})
+GENDER_FEMALE_TERMS = frozenset({"women", "womens", "woman", "female", "girls", "girl", "ladies", "lady"})
 ATTRIBUTE_MISMATCH_PENALTY = 1.5
 ATTRIBUTE_MATCH_BONUS = 0.6
 
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+# distinct lowercased titles whose token sets we keep around. keyed by title rather than _id: same title, same tokens,
+# and a doc whose title changes just gets a new entry. 50k small frozensets is a few tens of MB
+TOKEN_CACHE_SIZE = 50000
+
 model = None
+embed_disk_cache = None
+embed_batcher = None
+http_client = None
 
 
 # =============================================================================
 # app lifecycle
 # =============================================================================
 
-@app.on_event("startup")
 def load_model():
     """load the sentence-transformers model once at startup (used for query embedding)"""
-    global model
+    global model, embed_disk_cache, embed_batcher
     logger.info("Loading embedding model...")
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    logger.info("Model loaded.")
+    # the tokenizer's own rayon pool on top of torch threads + the API threadpool just oversubscribes; queries are one
+    # short string. has to be set before the first tokenizer is created
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    if USE_ONNX:
+        # never exported here: every uvicorn worker runs this, and they'd race on the same files. build it ahead of time
+        if not os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+            raise RuntimeError(
+                "USE_ONNX=1 but there's no %s in %s. export it first (e.g. in the image build): "
+                'python -c "import api.search_service as s; s._export_onnx_int8(s.ONNX_MODEL_DIR, s.ONNX_MODEL_FILE)"'
+                % (ONNX_MODEL_FILE, ONNX_MODEL_DIR)
+            )
+        model = OnnxEncoder(ONNX_MODEL_DIR, ONNX_MODEL_FILE)
+        # checked on every load, not just right after export, so a swapped or stale file can't slip through
+        if ONNX_MODEL_FILE != "model.onnx" and os.path.exists(os.path.join(ONNX_MODEL_DIR, "model.onnx")):
+            _check_quantized_encoder(ONNX_MODEL_DIR, model)
+    else:
+        torch.set_num_threads(TORCH_NUM_THREADS)
+        # one query at a time per forward pass, so inter-op parallelism only adds threads fighting the threadpool
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # can only be set once per process, before any parallel work (e.g. a second load_model in tests)
+        model = SentenceTransformer(EMBED_MODEL_NAME)
+        model.eval()
+        if TORCH_INT8:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    # one throwaway forward pass so lazy init (tokenizer files, kernels, allocator) happens here and not on the first real query.
+    # uvicorn doesn't take traffic until the lifespan startup returns, so /health only answers once this is done
+    with torch.inference_mode():
+        model.encode(_query_for_embedding("warmup"), normalize_embeddings=True)
+    logger.info("Model loaded and warmed up (%s).", _embed_backend())
+    embed_batcher = EmbedBatcher(embed_batch, EMBED_BATCH_SIZE, EMBED_BATCH_WAIT_MS / 1000.0)
+    if EMBED_CACHE_DIR:
+        import diskcache
+        embed_disk_cache = diskcache.Cache(EMBED_CACHE_DIR)
+        logger.info("Embedding disk cache at %s (%d entries)", EMBED_CACHE_DIR, len(embed_disk_cache))
+
+
+def open_http_client():
+    """one shared async client so every request reuses a pooled keep-alive connection. created at startup so it belongs to the server's event loop"""
+    global http_client
+    http_client = httpx.AsyncClient(
+        base_url=OPENSEARCH_URL,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=OPENSEARCH_MAX_CONNECTIONS, max_keepalive_connections=OPENSEARCH_MAX_KEEPALIVE),
+    )
+
+
+async def close_http_client():
+    if http_client is not None:
+        await http_client.aclose()
+
+
+HEALTH_BODY = b'{"ok":true}'
 
 
 @app.get("/health")
-def health():
-    return {"ok": True}
+async def health():
+    # prebuilt bytes: no dict, no serializer, the probe gets the same body every time
+    return Response(HEALTH_BODY, media_type="application/json")
 
 
 # =============================================================================
@@ -68,381 +198,415 @@ def health():
 
 def _query_for_embedding(raw_query: str) -> str:
     """stick the prefix on so we're embedding in the same space as the product text"""
-    q = (raw_query or "").strip()
+    # MiniLM is uncased and its tokenizer ignores runs of whitespace, so folding both doesn't change the vector,
+    # it just lets "Black  Jacket" and "black jacket" share a cache entry (in memory and on disk)
+    q = " ".join((raw_query or "").split()).lower()
     if not q:
         return q
     return QUERY_CONTEXT_PREFIX + q + QUERY_CONTEXT_SUFFIX
 
 
-@lru_cache(maxsize=1000)
-def embed_cached(query: str):
-    """cache embeddings per query so we don't re-encode the same thing"""
-    return model.encode(query).tolist()
+class OnnxEncoder:
+    """just enough of SentenceTransformer.encode on top of an ONNX export: tokenize, run, mean-pool, optionally L2-normalize"""
+
+    def __init__(self, model_dir: str, model_file: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        opts = ort.SessionOptions()
+        # fuse LayerNorm/GELU/attention and pick the fastest kernels once at load time
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.intra_op_num_threads = ONNX_NUM_THREADS
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, model_file), sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, sentences, batch_size: int = 32, normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        chunks = []
+        for start in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=ONNX_MAX_SEQ_LEN,
+                return_tensors="np",
+            )
+            feeds = {name: enc[name].astype(np.int64) for name in self.input_names if name in enc}
+            token_embs = self.session.run(None, feeds)[0]
+            # mean pooling over real tokens only, same as the sentence-transformers pooling layer
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            chunks.append((token_embs * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        embs = np.concatenate(chunks).astype(np.float32) if chunks else np.zeros((0, 0), dtype=np.float32)
+        if normalize_embeddings:
+            embs /= np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        return embs[0] if single else embs
+
+
+def _export_onnx_int8(model_dir: str, model_file: str):
+    """export MiniLM to ONNX and dynamically quantize it to int8 (VNNI kernels), tokenizer saved alongside. needs optimum installed"""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    hub_id = "sentence-transformers/" + EMBED_MODEL_NAME
+    ORTModelForFeatureExtraction.from_pretrained(hub_id, export=True).save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(hub_id).save_pretrained(model_dir)
+    quantizer = ORTQuantizer.from_pretrained(model_dir)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=model_dir, quantization_config=qconfig, file_suffix="quantized")
+    os.replace(os.path.join(model_dir, "model_quantized.onnx"), os.path.join(model_dir, model_file))
+    try:
+        _check_quantized_encoder(model_dir, OnnxEncoder(model_dir, model_file))
+    except RuntimeError:
+        # a bad export shouldn't be left around for the API to find
+        os.remove(os.path.join(model_dir, model_file))
+        raise
+
+
+def _check_quantized_encoder(model_dir: str, int8_encoder):
+    """int8 should barely move the vectors; if any sample query drifts more than ONNX_INT8_MIN_COSINE from the fp32
+    export (model.onnx in the same dir), refuse to start rather than serve quietly worse recall. read-only, so it's
+    safe with several workers loading the same files"""
+    texts = [_query_for_embedding(q) for q in ONNX_INT8_CHECK_QUERIES]
+    fp32 = OnnxEncoder(model_dir, "model.onnx").encode(texts, normalize_embeddings=True)
+    int8 = int8_encoder.encode(texts, normalize_embeddings=True)
+    worst = float(np.min(np.sum(fp32 * int8, axis=1)))
+    logger.info("int8 vs fp32 ONNX encoder: worst cosine %.4f over %d queries", worst, len(texts))
+    if worst < ONNX_INT8_MIN_COSINE:
+        raise RuntimeError(
+            "int8 ONNX model drifted from fp32 (worst cosine %.4f < %.2f). unset USE_ONNX for the PyTorch encoder, "
+            "or set ONNX_MODEL_FILE=model.onnx to serve the fp32 export"
+            % (worst, ONNX_INT8_MIN_COSINE)
+        )
+
+
+def _embed_backend() -> str:
+    if USE_ONNX:
+        return "onnx:" + ONNX_MODEL_FILE
+    return "torch-int8" if TORCH_INT8 else "torch"
+
+
+def _embed_disk_key(query: str) -> str:
+    """content address of the normalized query. model name + backend go in the key so swapping models (or fp32 <-> int8)
+    never serves stale vectors. blake2b is in the stdlib and faster than sha1 on short keys"""
+    return hashlib.blake2b(f"{EMBED_MODEL_NAME}::{_embed_backend()}::{query}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=EMBED_CACHE_SIZE)
+def embed_cached(query: str) -> np.ndarray:
+    """cache embeddings per query so we don't re-encode the same thing. unit-length float32, read-only since it's shared.
+    in-process LRU first, then the disk cache (if configured), then the model"""
+    key = _embed_disk_key(query) if embed_disk_cache is not None else None
+    raw = embed_disk_cache.get(key) if key else None
+    if raw is not None:
+        vec = np.frombuffer(raw, dtype=np.float32)
+    else:
+        if embed_batcher is not None:
+            vec = embed_batcher.submit(query)
+        else:
+            with torch.inference_mode():
+                vec = np.asarray(model.encode(query, normalize_embeddings=True), dtype=np.float32)
+        if key:
+            embed_disk_cache.set(key, vec.tobytes(), expire=EMBED_CACHE_TTL_S)
+    vec.flags.writeable = False
+    return vec
+
+
+def _quantize_int8(vec: np.ndarray) -> np.ndarray:
+    """the index stores int8 vectors (unit vector * 127), so the knn query has to be scaled the same way as ingest does it"""
+    return np.clip(np.round(np.asarray(vec, dtype=np.float32) * 127.0), -128, 127).astype(np.int8)
+
+
+@lru_cache(maxsize=EMBED_CACHE_SIZE)
+def _knn_vector_json(query: str) -> orjson.Fragment:
+    """the int8 knn query vector, already serialized. cached next to the embedding so a repeat query drops the
+    pre-encoded JSON straight into the search body instead of quantizing and re-encoding 384 numbers"""
+    vec = _quantize_int8(embed_cached(query))
+    return orjson.Fragment(orjson.dumps(vec, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+def embed_batch(queries: list) -> np.ndarray:
+    """encode several queries in one forward pass, one unit-length float32 row per query.
+    inference_mode is per-thread, so it's entered here (this runs on the batcher's worker thread)"""
+    with torch.inference_mode():
+        return np.asarray(
+            model.encode(queries, batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True),
+            dtype=np.float32,
+        )
+
+
+class EmbedBatcher:
+    """coalesce concurrent encode calls into one batched forward pass. callers (threadpool threads) block on a Future;
+    one worker thread takes the first queued text, collects whatever else is queued (waiting up to max_wait_s), encodes
+    them all at once and hands each caller its row"""
+
+    def __init__(self, encode_batch, max_batch: int, max_wait_s: float = 0.0):
+        self._encode_batch = encode_batch
+        self._max_batch = max_batch
+        self._max_wait_s = max_wait_s
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str) -> np.ndarray:
+        fut = Future()
+        self._queue.put((text, fut))
+        return fut.result()
+
+    def _collect(self) -> list:
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait_s
+        while len(items) < self._max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                items.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            try:
+                embs = self._encode_batch([text for text, _ in items])
+            except Exception as e:
+                for _, fut in items:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), row in zip(items, embs):
+                fut.set_result(row.copy())
 
 
 # =============================================================================
-# search ui (single-page html + js)
+# search ui (single-page html + js, lives in static/index.html)
 # =============================================================================
 
+with open(INDEX_HTML_PATH, "rb") as _f:
+    INDEX_HTML = _f.read()
+INDEX_HTML_ETAG = '"%s"' % hashlib.md5(INDEX_HTML).hexdigest()
+INDEX_HTML_HEADERS = {"ETag": INDEX_HTML_ETAG, "Cache-Control": "public, max-age=300"}
+
+
 @app.get("/", response_class=HTMLResponse)
-def home():
-    """serve the search page: search bar, category pills, results grid, why-this dialog"""
-    return r"""
-<!doctype html>
-<html lang="en">
-<head>
-<meta charset="utf-8"/>
-<meta name="viewport" content="width=device-width,initial-scale=1"/>
-<title>GKE Search · Semantic Apparel Intelligence</title>
-<link rel="preconnect" href="https://fonts.googleapis.com"/>
-<link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&display=swap" rel="stylesheet"/>
-<style>
-*{box-sizing:border-box;margin:0;padding:0}
-:root{
-  --bg:#06070A;
-  --glass:rgba(255,255,255,0.06);
-  --glass-strong:rgba(255,255,255,0.10);
-  --text:#FFFFFF;
-  --text-2:#A8AFBA;
-  --text-3:#6D7582;
-  --accent:#6366f1;
-  --accent-glow:rgba(99,102,241,0.35);
-  --accent-soft:rgba(99,102,241,0.18);
-  --danger:#EF4444;
-  --radius:14px;
-  --radius-lg:18px;
-  --shadow:0 24px 60px rgba(0,0,0,0.45);
-  --shadow-inner:inset 0 1px 0 rgba(255,255,255,0.06);
-}
-body{font-family:'Inter',system-ui,sans-serif;min-height:100vh;background:var(--bg);color:var(--text);-webkit-font-smoothing:antialiased;line-height:1.5}
-.dash{display:grid;grid-template-columns:260px 1fr;min-height:100vh}
-@media (max-width:1024px){.dash{grid-template-columns:1fr}}
-.sidebar{width:260px;background:var(--glass);backdrop-filter:blur(16px);border-right:1px solid rgba(255,255,255,0.06);padding:1.5rem 1.25rem;position:sticky;top:0;height:100vh}
-@media (max-width:1024px){.sidebar{display:none}}
-.sidebar .logo{display:flex;align-items:center;gap:0.5rem;margin-bottom:0.35rem}
-.sidebar .logo-dot{width:8px;height:8px;border-radius:50%;background:var(--accent);box-shadow:0 0 12px var(--accent-glow)}
-.sidebar .brand{font-size:1.125rem;font-weight:700;color:var(--text);letter-spacing:-0.02em}
-.sidebar .tagline{font-size:0.7rem;color:var(--text-3);letter-spacing:0.05em}
-.main{padding:1.5rem 1.75rem;overflow:auto}
-.glass-card{background:var(--glass);backdrop-filter:blur(18px);border-radius:var(--radius-lg);padding:2rem 2.25rem;margin-bottom:1.5rem;box-shadow:var(--shadow);border:1px solid rgba(255,255,255,0.06);box-shadow:var(--shadow),var(--shadow-inner)}
-.hero-title{font-size:1.5rem;font-weight:700;color:var(--text);letter-spacing:-0.03em;margin-bottom:0.35rem}
-.hero-sub{font-size:0.875rem;color:var(--text-2);margin-bottom:1.5rem;line-height:1.5}
-.search-row{display:flex;gap:0.75rem;align-items:stretch;margin-bottom:1rem}
-.search-wrap{flex:1;min-width:200px;position:relative}
-.search-wrap svg{position:absolute;left:1rem;top:50%;transform:translateY(-50%);width:1.125rem;height:1.125rem;color:var(--text-3);pointer-events:none}
-.search-wrap input{width:100%;height:52px;padding:0 1rem 0 2.75rem;font-size:0.9375rem;background:rgba(255,255,255,0.07);border:1px solid rgba(255,255,255,0.08);border-radius:16px;color:var(--text);outline:none;transition:border-color 0.2s,box-shadow 0.2s}
-.search-wrap input:focus{border-color:var(--accent);box-shadow:0 0 0 3px var(--accent-soft)}
-.search-wrap input::placeholder{color:var(--text-3)}
-.btn-search{height:52px;padding:0 1.5rem;font-size:0.9375rem;font-weight:600;color:#fff;background:var(--accent);border:none;border-radius:999px;cursor:pointer;transition:all 0.2s;box-shadow:0 8px 24px var(--accent-glow)}
-.btn-search:hover{filter:brightness(1.08);transform:translateY(-1px);box-shadow:0 12px 32px var(--accent-glow)}
-.intent-strip{display:flex;flex-wrap:wrap;gap:0.5rem;align-items:center;margin-top:1rem}
-.intent-tag{font-size:0.75rem;padding:0.35rem 0.7rem;background:var(--glass);border-radius:999px;color:var(--text-2);border:1px solid rgba(255,255,255,0.06)}
-.confidence-bar{height:4px;background:rgba(255,255,255,0.08);border-radius:999px;margin-top:1rem;overflow:hidden}
-.confidence-fill{height:100%;background:var(--accent);border-radius:999px;width:78%;box-shadow:0 0 12px var(--accent-glow);transition:width 0.3s}
-.pills{display:flex;flex-wrap:wrap;gap:0.5rem;margin-top:1.25rem}
-.pill{padding:0.45rem 1rem;font-size:0.8125rem;font-weight:500;border-radius:999px;background:var(--glass);border:1px solid rgba(255,255,255,0.08);color:var(--text-2);cursor:pointer;transition:all 0.2s}
-.pill:hover{background:var(--glass-strong);color:var(--text)}
-.pill.active{background:var(--accent-soft);color:var(--accent);border-color:rgba(99,102,241,0.4);box-shadow:0 0 0 1px rgba(99,102,241,0.25)}
-.results-header{display:flex;flex-wrap:wrap;gap:1rem;align-items:center;justify-content:space-between;margin-bottom:1.25rem}
-.results-header h3{font-size:1.125rem;font-weight:700;color:var(--text);letter-spacing:-0.02em}
-.results-header p{font-size:0.8125rem;color:var(--text-3);margin-top:0.2rem}
-.grid-results{display:grid;gap:1.25rem;grid-template-columns:repeat(2,1fr)}
-@media (min-width:900px){.grid-results{grid-template-columns:repeat(2,1fr)}}
-.card-result{background:var(--glass);backdrop-filter:blur(12px);border-radius:var(--radius-lg);padding:1.25rem;border:1px solid rgba(255,255,255,0.06);box-shadow:0 12px 40px rgba(0,0,0,0.35);transition:all 0.2s}
-.card-result:hover{border-color:rgba(255,255,255,0.1);box-shadow:0 16px 48px rgba(0,0,0,0.4)}
-.card-result .cat{font-size:0.65rem;font-weight:600;letter-spacing:0.12em;text-transform:uppercase;color:var(--text-3);margin-bottom:0.4rem}
-.card-result .title{font-size:0.9rem;font-weight:600;color:var(--text);line-height:1.4;margin-bottom:0.75rem}
-.score-bar-wrap{margin-bottom:0.75rem}
-.score-bar{height:6px;background:rgba(255,255,255,0.08);border-radius:999px;overflow:hidden}
-.score-bar-fill{height:100%;background:linear-gradient(90deg,var(--accent),rgba(99,102,241,0.6));border-radius:999px;box-shadow:0 0 10px var(--accent-glow)}
-.card-result .meta{font-size:0.75rem;color:var(--text-3);margin-bottom:0.75rem}
-.btn-why{padding:0.5rem 0.9rem;font-size:0.75rem;font-weight:500;color:var(--accent);background:transparent;border:1px solid rgba(99,102,241,0.4);border-radius:999px;cursor:pointer;transition:all 0.2s;width:100%}
-.btn-why:hover{background:var(--accent-soft);border-color:var(--accent)}
-.empty-msg,.err-msg{font-size:0.875rem;color:var(--text-3);line-height:1.5;margin-top:0.5rem}
-.err-msg{color:var(--danger)}
-.dialog-overlay{position:fixed;inset:0;z-index:50;background:rgba(0,0,0,0.6);backdrop-filter:blur(8px);display:none;align-items:center;justify-content:center;padding:1.5rem}
-.dialog-overlay.open{display:flex}
-.dialog-box{background:var(--glass-strong);backdrop-filter:blur(20px);border-radius:var(--radius-lg);padding:1.75rem;max-width:24rem;width:100%;border:1px solid rgba(255,255,255,0.08);box-shadow:var(--shadow)}
-.dialog-box h4{font-size:1rem;font-weight:700;color:var(--text);margin-bottom:0.6rem}
-.dialog-box p{font-size:0.875rem;color:var(--text-2);line-height:1.55}
-.dialog-close{float:right;margin:-0.25rem -0.25rem 0.5rem 0.5rem;padding:0.5rem;border:none;background:transparent;color:var(--text-3);cursor:pointer;border-radius:999px}
-.dialog-close:hover{background:var(--glass);color:var(--text)}
-</style>
-</head>
-<body>
-<div class="dash">
-<aside class="sidebar">
-  <div class="logo"><span class="logo-dot"></span><span class="brand">GKE Search</span></div>
-  <p class="tagline">Semantic Apparel Intelligence</p>
-</aside>
-<main class="main">
-  <div class="glass-card">
-    <h1 class="hero-title">Semantic Clothing Search</h1>
-    <p class="hero-sub">Understands intent, vibe, seasonality, and style similarity.</p>
-    <form class="search-row" onsubmit="return runSearch(event)">
-      <div class="search-wrap">
-        <svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M21 21l-6-6m2-5a7 7 0 11-14 0 7 7 0 0114 0z"/></svg>
-        <input id="query" type="text" placeholder="e.g. minimal black oversized tee for summer" autofocus/>
-      </div>
-      <button type="submit" class="btn-search">Search</button>
-    </form>
-    <div class="intent-strip" id="intent-strip">
-      <span class="intent-tag">Style: —</span><span class="intent-tag">Color: —</span><span class="intent-tag">Fit: —</span><span class="intent-tag">Season: —</span>
-    </div>
-    <div class="confidence-bar"><div class="confidence-fill" id="confidence-fill"></div></div>
-    <div class="pills">
-      <button type="button" class="pill active" data-q="">All</button>
-      <button type="button" class="pill" data-q="jacket">Jackets</button>
-      <button type="button" class="pill" data-q="dress">Dresses</button>
-      <button type="button" class="pill" data-q="shoes">Shoes</button>
-      <button type="button" class="pill" data-q="bag">Bags</button>
-    </div>
-  </div>
-  <div class="results-header">
-    <div>
-      <h3 id="results-title">Recommended for you</h3>
-      <p id="results-subtitle">Run a search or pick a category above.</p>
-    </div>
-  </div>
-  <div class="grid-results" id="results"></div>
-  <p class="empty-msg" id="empty-msg" style="display:none">No results yet. Try a more specific query or check that OpenSearch is running.</p>
-  <p class="err-msg" id="err-msg" style="display:none"></p>
-</main>
-</div>
-<div class="dialog-overlay" id="dialog" aria-hidden="true">
-  <div class="dialog-box">
-    <button type="button" class="dialog-close" onclick="closeDialog()" aria-label="Close">&times;</button>
-    <h4 id="dialog-title">Why this result?</h4>
-    <p id="dialog-body">Relevance blend: vector similarity + keyword overlap.</p>
-  </div>
-</div>
-<script>
-function runSearch(e){ e.preventDefault(); search(); return false; }
-function setPills(){
-  var q = document.getElementById("query").value.trim().toLowerCase();
-  document.querySelectorAll(".pills .pill").forEach(function(btn){
-    var d = (btn.dataset.q || "").toLowerCase();
-    btn.classList.toggle("active", d === q || (d === "" && !q));
-  });
-}
-function updateIntentStrip(q){
-  var strip = document.getElementById("intent-strip");
-  if (!strip) return;
-  var tokens = q ? q.split(/\s+/).filter(function(t){ return t.length > 1; }).slice(0,5) : [];
-  if (tokens.length === 0) { strip.innerHTML = "<span class=\"intent-tag\">Style: —</span><span class=\"intent-tag\">Color: —</span><span class=\"intent-tag\">Fit: —</span>"; return; }
-  strip.innerHTML = tokens.map(function(t){ return "<span class=\"intent-tag\">" + t + "</span>"; }).join("");
-  var fill = document.getElementById("confidence-fill");
-  if (fill) fill.style.width = Math.min(60 + tokens.length * 8, 95) + "%";
-}
-function search(optionalQ){
-  var q = (optionalQ !== undefined ? optionalQ : document.getElementById("query").value.trim());
-  document.getElementById("query").value = q;
-  setPills();
-  updateIntentStrip(q);
-  var resEl = document.getElementById("results");
-  var titleEl = document.getElementById("results-title");
-  var subEl = document.getElementById("results-subtitle");
-  var emptyEl = document.getElementById("empty-msg");
-  var errEl = document.getElementById("err-msg");
-  resEl.innerHTML = "";
-  emptyEl.style.display = "none";
-  errEl.style.display = "none";
-  if (!q) { titleEl.textContent = "Recommended for you"; subEl.textContent = "Run a search or pick a category above."; return; }
-  titleEl.textContent = "Searching…";
-  subEl.textContent = "";
-  fetch("/search?q=" + encodeURIComponent(q) + "&k=6").then(function(r){
-   if (!r.ok) {
-     return r.json().then(function(d){ throw new Error(d.detail || d.message || r.statusText); }).catch(function(){ throw new Error(r.statusText); });
-   }
-   return r.json();
- }).then(function(data){
-    titleEl.textContent = (data && data.length) ? ("Top matches for \u201c" + q + "\u201d") : ("No results for \u201c" + q + "\u201d");
-    subEl.textContent = (data && data.length) ? (data.length + " results") : "Try a different query.";
-    if (!Array.isArray(data) || !data.length) { emptyEl.style.display = "block"; return; }
-    var maxScore = Math.max.apply(null, data.map(function(x){ return x.score != null ? x.score : 0; }));
-    if (maxScore <= 0) maxScore = 1;
-    data.forEach(function(item){
-      var title = (item.title || "").replace(/&/g,"&amp;").replace(/</g,"&lt;").replace(/>/g,"&gt;").replace(/"/g,"&quot;");
-      var raw = item.score != null ? item.score : 0;
-      var score = maxScore > 0 ? raw / maxScore : 0;
-      var pct = Math.round(Math.min(100, Math.max(0, score * 100)));
-      var card = document.createElement("div");
-      card.className = "card-result";
-      card.innerHTML = "<div class=\"cat\">PRODUCT</div><div class=\"title\">" + title + "</div><div class=\"score-bar-wrap\"><div class=\"score-bar\"><div class=\"score-bar-fill\" style=\"width:" + pct + "%\"></div></div></div><div class=\"meta\">Semantic match " + pct + "%</div><button type=\"button\" class=\"btn-why\">Why this?</button>";
-      card.querySelector(".btn-why").onclick = function(){ openDialog(item.title, item.score); };
-      resEl.appendChild(card);
-    });
-  }).catch(function(e){ titleEl.textContent = "Search failed"; subEl.textContent = ""; errEl.textContent = (e && e.message ? e.message : "Server or OpenSearch unavailable."); errEl.style.display = "block"; });
-}
-document.querySelectorAll(".pills .pill").forEach(function(btn){
-  btn.addEventListener("click", function(){ var q = btn.dataset.q || ""; document.getElementById("query").value = q; search(q); });
-});
-function openDialog(title, score){
-  document.getElementById("dialog-title").textContent = "Why this result?";
-  var t = (title || "").replace(/</g,"&lt;").replace(/>/g,"&gt;").substring(0,100);
-  if ((title || "").length > 100) t += "\u2026";
-  document.getElementById("dialog-body").innerHTML = (t ? "<strong style=\"color:#fff\">" + t + "</strong><br><br>" : "") + "Embedding similarity + attribute alignment + keyword overlap. Final blended score: <strong style=\"color:#6366f1\">" + (score != null ? score.toFixed(4) : "\u2014") + "</strong>.";
-  document.getElementById("dialog").classList.add("open");
-  document.getElementById("dialog").setAttribute("aria-hidden","false");
-}
-function closeDialog(){ document.getElementById("dialog").classList.remove("open"); document.getElementById("dialog").setAttribute("aria-hidden","true"); }
-document.getElementById("dialog").addEventListener("click", function(e){ if (e.target === this) closeDialog(); });
-</script>
-</body>
-</html>
-"""
+async def home(request: Request):
+    """serve the search page: search bar, category pills, results grid, why-this dialog. bytes are read once at import;
+    browsers that already have this version get a 304"""
+    if request.headers.get("if-none-match") == INDEX_HTML_ETAG:
+        return Response(status_code=304, headers=INDEX_HTML_HEADERS)
+    return Response(INDEX_HTML, media_type="text/html; charset=utf-8", headers=INDEX_HTML_HEADERS)
 
 
 # =============================================================================
 # opensearch
 # =============================================================================
 
-def _run_search(url: str, body: dict, timeout: int = 10) -> requests.Response:
-    """POST the search body to OpenSearch, return the response"""
-    return requests.post(url, json=body, timeout=timeout)
+async def _run_search(body: dict, params: dict = None, timeout: int = 10) -> httpx.Response:
+    """one _search on the index. OPT_SERIALIZE_NUMPY so numpy values in the body need no tolist() detour.
+    params for things like a search pipeline"""
+    return await http_client.post(
+        f"/{INDEX_NAME}/_search",
+        params=params,
+        content=orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY),
+        headers={"Content-Type": "application/json"},
+        timeout=timeout,
+    )
+
+
+async def _run_mget(docs: list, timeout: int = 10) -> httpx.Response:
+    """fetch just the title from _source for specific docs ({"_index", "_id"} pairs)"""
+    return await http_client.post(
+        "/_mget",
+        params={"_source": "title"},
+        content=orjson.dumps({"docs": docs}),
+        headers={"Content-Type": "application/json"},
+        timeout=timeout,
+    )
 
 
 # =============================================================================
 # scoring helpers (cosine, scale, tokenize, attribute, keyword, rrf)
 # =============================================================================
 
-def _cosine_sim(query_vec: np.ndarray, doc_vec: np.ndarray) -> float:
-    """cosine sim is in [-1,1]; squash to [0,1] so we can use it as a score"""
-    a, b = np.asarray(query_vec, dtype=float), np.asarray(doc_vec, dtype=float)
-    n = np.dot(a, b)
-    d = np.linalg.norm(a) * np.linalg.norm(b)
-    if d <= 1e-9:
-        return 0.0
-    cos = n / d
-    return (float(cos) + 1.0) / 2.0
+def _cosine_sims(query_vec: np.ndarray, doc_mat: np.ndarray) -> np.ndarray:
+    """cosine sim of the query against every row of doc_mat in one matmul, squashed from [-1,1] to [0,1]. zero-norm rows get 0"""
+    q = np.asarray(query_vec, dtype=np.float32)
+    q_norm = np.linalg.norm(q)
+    if q_norm <= 1e-9:
+        return np.zeros(len(doc_mat), dtype=np.float32)
+    doc_norms = np.linalg.norm(doc_mat, axis=1)
+    ok = doc_norms > 1e-9
+    cos = (doc_mat @ (q / q_norm)) / np.where(ok, doc_norms, 1.0)
+    return np.where(ok, (cos + 1.0) * 0.5, 0.0)
+
+
+def _min_max_scale(scores) -> np.ndarray:
+    """normalize so the best is 1 and worst is 0, rest spread in between (whole array at once)"""
+    arr = np.asarray(scores, dtype=np.float64)
+    if arr.size == 0:
+        return arr
+    lo = arr.min()
+    span = arr.max() - lo
+    if span <= 1e-9:
+        return np.ones_like(arr)
+    return (arr - lo) / span
 
 
-def _min_max_scale(scores: list) -> list:
-    """normalize so the best is 1 and worst is 0, rest spread in between"""
-    if not scores:
-        return scores
-    lo, hi = min(scores), max(scores)
-    span = hi - lo
-    if span <= 1e-9:
-        return [1.0] * len(scores)
-    return [(s - lo) / span for s in scores]
-
-
-def _tokenize_text(text: str) -> list:
-    """chop into words for matching (lowercase, alphanumeric chunks only)"""
-    return re.findall(r"[a-z0-9]+", text.lower())
-
-
-def _attribute_adjustment(query_lower: str, title_lower: str) -> float:
-    """if they asked for men and the doc says women (or the other way), knock it down. if it matches, bump it up"""
-    q_words = set(_tokenize_text(query_lower))
-    t_words = set(_tokenize_text(title_lower))
-    q_male = q_words & GENDER_MALE_TERMS
-    q_female = q_words & GENDER_FEMALE_TERMS
-    t_male = t_words & GENDER_MALE_TERMS
-    t_female = t_words & GENDER_FEMALE_TERMS
-    if q_male and t_female:
-        return -ATTRIBUTE_MISMATCH_PENALTY
-    if q_female and t_male:
-        return -ATTRIBUTE_MISMATCH_PENALTY
-    if q_male and t_male:
-        return ATTRIBUTE_MATCH_BONUS
-    if q_female and t_female:
-        return ATTRIBUTE_MATCH_BONUS
-    return 0.0
-
-
-def _keyword_score_bm25_style(title: str, content_tokens: list, q_lower: str) -> float:
-    """keyword score: more mentions = higher, substring matches get some credit, exact phrase gets a boost"""
-    if not content_tokens:
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _word_set(text_lower: str) -> frozenset:
+    """chop into words for matching (alphanumeric chunks only). input is already lowercased; cached since the same product titles come back query after query"""
+    return frozenset(TOKEN_RE.findall(text_lower))
+
+
+def _attribute_adjustments(q_words: frozenset, t_male: np.ndarray, t_female: np.ndarray) -> np.ndarray:
+    """if they asked for men and the doc says women (or the other way), knock it down. if it matches, bump it up.
+    t_male / t_female flag which titles mention each gender; returns one adjustment per title"""
+    q_male = bool(q_words & GENDER_MALE_TERMS)
+    q_female = bool(q_words & GENDER_FEMALE_TERMS)
+    mismatch = (q_male & t_female) | (q_female & t_male)
+    match = (q_male & t_male) | (q_female & t_female)
+    return np.where(mismatch, -ATTRIBUTE_MISMATCH_PENALTY, np.where(match, ATTRIBUTE_MATCH_BONUS, 0.0))
+
+
+@lru_cache(maxsize=EMBED_CACHE_SIZE)
+def _content_tokens(q_lower: str) -> tuple:
+    """query words minus stopwords; if the query is nothing but stopwords, keep them all.
+    cached like the embedding (same repeat queries), tuple so the shared value can't be mutated"""
+    query_tokens = tuple(q_lower.split())
+    return tuple(t for t in query_tokens if t not in STOPWORDS) or query_tokens
+
+
+def _keyword_score_bm25_style(title_lower: str, title_words: frozenset, content_counts: Counter, q_lower: str) -> float:
+    """keyword score: more mentions = higher, substring matches get some credit, exact phrase gets a boost.
+    content_counts is the query's content tokens with multiplicity, so a repeated token is only scored once"""
+    n_content = sum(content_counts.values())
+    if not n_content:
         return 0.0
-    title_lower = title.lower()
-    title_words = set(_tokenize_text(title))
     score = 0.0
-    for t in content_tokens:
+    for t, n in content_counts.items():
         tf = title_lower.count(t)
         if tf > 0:
-            score += math.log1p(tf)
-        else:
-            for w in title_words:
-                if t in w or w in t:
-                    score += 0.5
-                    break
-    raw = score / len(content_tokens)
+            score += n * math.log1p(tf)
+        # t isn't in the title at all here, so it can't be inside any title word; only the word-inside-token case is left
+        elif any(w in t for w in title_words):
+            score += n * 0.5
+    raw = score / n_content
     if q_lower in title_lower:
         raw += 0.5
     return max(0.0, raw)
 
 
-def _rrf_fuse(vector_scores: list, keyword_scores: list) -> list:
+def _rrf_fuse(vector_scores: np.ndarray, keyword_scores: np.ndarray) -> np.ndarray:
     """combine the two rank lists with RRF so we don't have to worry about one score dominating the other"""
-    n = len(vector_scores)
     rank_v = _scores_to_rank(vector_scores, descending=True)
     rank_k = _scores_to_rank(keyword_scores, descending=True)
-    return [1.0 / (RRF_K + rank_v[i]) + 1.0 / (RRF_K + rank_k[i]) for i in range(n)]
+    return 1.0 / (RRF_K + rank_v) + 1.0 / (RRF_K + rank_k)
 
 
-def _scores_to_rank(scores: list, descending: bool = True) -> list:
-    """turn scores into ranks (1 = best, 2 = second, ...)"""
-    order = sorted(range(len(scores)), key=lambda i: scores[i], reverse=descending)
-    rank = [0] * len(scores)
-    r = 1
-    for i in order:
-        rank[i] = r
-        r += 1
+def _scores_to_rank(scores: np.ndarray, descending: bool = True) -> np.ndarray:
+    """turn scores into ranks (1 = best, 2 = second, ...). ties keep their original order"""
+    arr = np.asarray(scores, dtype=np.float64)
+    order = np.argsort(-arr if descending else arr, kind="stable")
+    rank = np.empty(len(arr), dtype=np.int64)
+    rank[order] = np.arange(1, len(arr) + 1)
     return rank
 
 
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """indices of the k best scores, best first, ties by position. RRF ties are common ((a, b) and (b, a) rank pairs
+    score the same), so this has to be a stable sort; at <= 50 candidates that costs nothing"""
+    return np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")[:k]
+
+
+# titles come off the title.raw doc value; _source is only fetched where a hit still needs it (the fallback's vectors)
+TITLE_DOCVALUE_FIELDS = ["title.raw", "title_tokens"]
+
+
+def _hit_title(h: dict) -> str:
+    """title from doc values, or from _source (filled in by _fill_missing_titles when there's no doc value)"""
+    raw = h.get("fields", {}).get("title.raw")
+    if raw:
+        return raw[0]
+    return h.get("_source", {}).get("title", "")
+
+
+async def _fill_missing_titles(hits: list):
+    """hits with no title.raw doc value (index built before it existed, or a title past ignore_above) get their title
+    from _source with one _mget, so they still get keyword/gender scoring. normal hits never pay for this"""
+    missing = [h for h in hits if not h.get("fields", {}).get("title.raw") and "title" not in h.get("_source", {})]
+    if not missing:
+        return
+    try:
+        r = await _run_mget([{"_index": h.get("_index", INDEX_NAME), "_id": h["_id"]} for h in missing])
+    except httpx.HTTPError as e:
+        logger.warning("Title lookup for %d hits failed: %s", len(missing), str(e))
+        return
+    if r.status_code >= 400:
+        logger.warning("Title lookup for %d hits failed (%s): %s", len(missing), r.status_code, (r.text or "")[:200])
+        return
+    titles = {
+        (d.get("_index"), d.get("_id")): d.get("_source", {}).get("title", "")
+        for d in orjson.loads(r.content).get("docs", [])
+        if d.get("found")
+    }
+    for h in missing:
+        h.setdefault("_source", {})["title"] = titles.get((h.get("_index", INDEX_NAME), h["_id"]), "")
+
+
 # --- re-rank pipeline: take knn hits, score with semantic + keyword + gender, fuse with RRF, return top k ---
 
-def _hits_to_results(hits: list, q: str, k: int, query_embedding: list = None) -> list:
+def _hits_to_results(hits: list, q: str, k: int, query_embedding: np.ndarray = None) -> list:
     """re-rank: semantic (cosine) + keyword (tf + substring + phrase + gender), then fuse with RRF and return top k"""
-    query_tokens = q.lower().split()
-    content_tokens = [t for t in query_tokens if t not in STOPWORDS]
-    if not content_tokens:
-        content_tokens = query_tokens
     q_lower = q.lower()
+    content_counts = Counter(_content_tokens(q_lower))
+    q_words = _word_set(q_lower)
 
     has_embeddings = (
         query_embedding is not None
         and hits
         and isinstance(hits[0].get("_source", {}).get("embedding"), (list, np.ndarray))
     )
-    query_vec = np.array(query_embedding, dtype=float) if query_embedding else None
 
+    # one pass over the hits: pull out titles, fill the doc-vector matrix and score keywords as we go
+    n = len(hits)
+    doc_mat = np.zeros((n, len(query_embedding)), dtype=np.float32) if has_embeddings else None
+    titles = []
     raw_vector_scores = []
-    for h in hits:
-        if has_embeddings and query_vec is not None:
-            doc_emb = h["_source"].get("embedding")
+    base_scores = np.empty(n, dtype=np.float64)
+    t_male = np.empty(n, dtype=bool)
+    t_female = np.empty(n, dtype=bool)
+    for row, h in enumerate(hits):
+        if has_embeddings:
+            doc_emb = h.get("_source", {}).get("embedding")
             if doc_emb is not None:
-                raw_vector_scores.append(_cosine_sim(query_vec, doc_emb))
-            else:
-                raw_vector_scores.append(0.0)
+                doc_mat[row] = doc_emb
         else:
             raw_vector_scores.append(float(h.get("_score") or 0))
-
-    vector_scores = _min_max_scale(raw_vector_scores)
-    keyword_scores = []
-    for h in hits:
-        title = h["_source"].get("title", "")
+        title = _hit_title(h)
+        titles.append(title)
         title_lower = title.lower()
-        base = _keyword_score_bm25_style(title, content_tokens, q_lower)
-        attr = _attribute_adjustment(q_lower, title_lower)
-        keyword_scores.append(max(0.0, base + attr))
-    keyword_scores = _min_max_scale(keyword_scores)
+        # ingest stores the title's token set (read from doc values); only older indexes without it need tokenizing here
+        stored_tokens = h.get("fields", {}).get("title_tokens")
+        title_words = frozenset(stored_tokens) if stored_tokens is not None else _word_set(title_lower)
+        base_scores[row] = _keyword_score_bm25_style(title_lower, title_words, content_counts, q_lower)
+        t_male[row] = not title_words.isdisjoint(GENDER_MALE_TERMS)
+        t_female[row] = not title_words.isdisjoint(GENDER_FEMALE_TERMS)
+
+    if has_embeddings:
+        # every doc vector is in one (n, dim) matrix so cosine is a single matmul instead of one per hit
+        raw_vector_scores = _cosine_sims(query_embedding, doc_mat)
+    vector_scores = _min_max_scale(raw_vector_scores)
+    keyword_scores = _min_max_scale(np.maximum(0.0, base_scores + _attribute_adjustments(q_words, t_male, t_female)))
 
     rrf_scores = _rrf_fuse(vector_scores, keyword_scores)
-    order = sorted(range(len(rrf_scores)), key=lambda i: rrf_scores[i], reverse=True)
-    ordered_rrf = [rrf_scores[i] for i in order[:k]]
+    order = _top_k_indices(rrf_scores, k)
     # scale so the top hit shows as 100% in the UI
-    display_scores = _min_max_scale(ordered_rrf) if ordered_rrf else []
+    display_scores = _min_max_scale(rrf_scores[order]).tolist()
 
-    results = []
-    for j, i in enumerate(order[:k]):
-        title = hits[i]["_source"].get("title", "")
-        results.append({"title": title, "score": display_scores[j] if j < len(display_scores) else rrf_scores[i]})
-
-    return results
+    return [{"title": titles[i], "score": score} for i, score in zip(order.tolist(), display_scores)]
 
 
 # =============================================================================
@@ -462,9 +626,53 @@ def _opensearch_error_detail(status_code: int, text: str) -> str:
     return (text[:300] + "…") if text and len(text) > 300 else (text or "Unknown error")
 
 
+async def _hybrid_search(q: str, embed_query: str, k: int):
+    """knn + title match combined inside OpenSearch (hybrid query + normalization pipeline), only top k come back.
+    no gender/substring re-rank on this path. returns None if OpenSearch can't run it so the caller uses the re-rank"""
+    body = {
+        "size": k,
+        "track_total_hits": False,
+        "_source": False,
+        "docvalue_fields": ["title.raw"],
+        "query": {
+            "hybrid": {
+                "queries": [
+                    {"knn": {"embedding": {"vector": _knn_vector_json(embed_query), "k": 50}}},
+                    {"match": {"title": {"query": q}}},
+                ]
+            }
+        },
+    }
+    try:
+        r = await _run_search(body, params={"search_pipeline": HYBRID_PIPELINE})
+    except httpx.HTTPError as e:
+        logger.warning("Hybrid search unreachable, using the re-rank path: %s", str(e))
+        return None
+    if r.status_code >= 400:
+        logger.warning("Hybrid search failed (%s), using the re-rank path: %s", r.status_code, (r.text or "")[:200])
+        return None
+    hits = orjson.loads(r.content).get("hits", {}).get("hits", [])
+    await _fill_missing_titles(hits)
+    # scale so the top hit shows as 100% in the UI, same as the re-rank
+    scores = _min_max_scale([float(h.get("_score") or 0) for h in hits]).tolist()
+    return [{"title": _hit_title(h), "score": score} for h, score in zip(hits, scores)]
+
+
+async def _search_one(body: dict) -> httpx.Response:
+    """run one search body; unreachable OpenSearch is a 503, an error status is left for the caller to handle"""
+    try:
+        return await _run_search(body)
+    except httpx.HTTPError as e:
+        logger.warning("OpenSearch unreachable: %s", str(e))
+        raise HTTPException(
+            status_code=503,
+            detail="OpenSearch is not running or not reachable. Check that the OpenSearch pod is up and OPENSEARCH_URL is correct. (%s)" % str(e),
+        )
+
+
 @app.get("/search")
-def search(q: str, k: int = 5):
-    """vector search first (knn), then re-rank with semantic + keyword + gender; if knn fails we fall back to plain match on title"""
+async def search(q: str, k: int = 5):
+    """knn search, re-rank the hits with semantic + keyword + gender; if knn errored we run a plain title match instead"""
     if not q or not q.strip():
         raise HTTPException(status_code=400, detail="Query cannot be empty")
     if k < 1 or k > 50:
@@ -472,55 +680,58 @@ def search(q: str, k: int = 5):
 
     q = q.strip()
     logger.info("Search query received: %s", q)
-    url = f"{OPENSEARCH_URL}/{INDEX_NAME}/_search"
 
     try:
-        # try vector search first (we embed the query with the same prefix as the docs)
-        try:
-            embedding = embed_cached(_query_for_embedding(q))
-            knn_body = {
-                "size": 50,
+        # we embed the query with the same prefix as the docs
+        # encoding is CPU-bound, keep it off the event loop so other requests keep moving
+        embed_query = _query_for_embedding(q)
+        embedding = await run_in_threadpool(embed_cached, embed_query)
+        if HYBRID_SEARCH:
+            results = await _hybrid_search(q, embed_query, k)
+            if results is not None:
+                return results
+        # knn _score is monotonic in cosine and RRF only looks at ranks, so the 384-float doc vectors aren't worth shipping back
+        knn_body = {
+            "size": 50,
+            # we only look at the hits, never hits.total, so don't make the shards count every match
+            "track_total_hits": False,
+            # nothing from _source: title and title_tokens are both keyword doc values
+            "_source": False,
+            "docvalue_fields": TITLE_DOCVALUE_FIELDS,
+            # OpenSearch k-NN plugin syntax (the top-level "knn" section is Elasticsearch-only and gets rejected here)
+            "query": {
                 "knn": {
-                    "field": "embedding",
-                    "query_vector": embedding,
-                    "k": 50,
-                    "num_candidates": 50
+                    "embedding": {
+                        "vector": _knn_vector_json(embed_query),
+                        "k": 50
+                    }
                 }
             }
-            r = _run_search(url, knn_body)
-            if r.status_code < 400:
-                hits = r.json().get("hits", {}).get("hits", [])
-                return _hits_to_results(hits, q, k, query_embedding=embedding)
-
-            # knn failed, fall back to plain text match on title
-            logger.warning("KNN search failed (%s), trying match fallback: %s", r.status_code, r.text[:200])
-        except requests.RequestException as e:
-            logger.warning("OpenSearch unreachable: %s", str(e))
-            raise HTTPException(
-                status_code=503,
-                detail="OpenSearch is not running or not reachable. Check that the OpenSearch pod is up and OPENSEARCH_URL is correct. (%s)" % str(e),
-            )
-
-        # fallback: just match on title (no vectors)
-        try:
-            match_body = {
-                "size": 50,
-                "query": {"match": {"title": {"query": q, "fuzziness": "AUTO"}}},
-            }
-            r2 = _run_search(url, match_body)
-            if r2.status_code >= 400:
-                detail = _opensearch_error_detail(r2.status_code, r2.text or "")
-                logger.error("Fallback match failed: %s", detail)
-                raise HTTPException(status_code=503, detail=detail)
-            hits = r2.json().get("hits", {}).get("hits", [])
-            embedding = embed_cached(_query_for_embedding(q))
+        }
+        r = await _search_one(knn_body)
+        if r.status_code < 400:
+            hits = orjson.loads(r.content).get("hits", {}).get("hits", [])
+            await _fill_missing_titles(hits)
             return _hits_to_results(hits, q, k, query_embedding=embedding)
-        except requests.RequestException as e:
-            logger.warning("OpenSearch unreachable: %s", str(e))
-            raise HTTPException(
-                status_code=503,
-                detail="OpenSearch is not running or not reachable. (%s)" % str(e),
-            )
+
+        # knn failed, fall back to plain text match on title. only sent now so the normal path does one search, not two.
+        # its hits are BM25-ranked though, so it still needs the doc vectors for the semantic half of the re-rank
+        logger.warning("KNN search failed (%s), using match fallback: %s", r.status_code, (r.text or "")[:200])
+        match_body = {
+            "size": 50,
+            "track_total_hits": False,
+            "_source": ["embedding"],
+            "docvalue_fields": TITLE_DOCVALUE_FIELDS,
+            "query": {"match": {"title": {"query": q, "fuzziness": "AUTO"}}},
+        }
+        r = await _search_one(match_body)
+        if r.status_code >= 400:
+            detail = _opensearch_error_detail(r.status_code, r.text or "")
+            logger.error("Fallback match failed: %s", detail)
+            raise HTTPException(status_code=503, detail=detail)
+        hits = orjson.loads(r.content).get("hits", {}).get("hits", [])
+        await _fill_missing_titles(hits)
+        return _hits_to_results(hits, q, k, query_embedding=embedding)
     except HTTPException:
         raise
     except Exception as e:
@@ -528,4 +739,4 @@ def search(q: str, k: int = 5):
         raise HTTPException(
             status_code=500,
             detail="Search failed: %s. Check server logs." % str(e),
-        ) 
\ No newline at end of file
+        )
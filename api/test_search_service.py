@@ -1,19 +1,21 @@
 """minimal tests for the search API (homepage, search returns shape, empty query rejected)"""
 
+import logging
+
+import numpy as np
+import orjson
 from fastapi.testclient import TestClient
 
 import search_service as svc
 
 
 class DummyResponse:
+    """fake _search response: hits on success, or an error status + body"""
     def __init__(self, status_code=200, hits=None, text=""):
         self.status_code = status_code
-        self._hits = hits or []
+        self.content = orjson.dumps({"hits": {"hits": hits or []}})
         self.text = text
 
-    def json(self):
-        return {"hits": {"hits": self._hits}}
-
 
 def test_homepage_renders():
     client = TestClient(svc.app)
@@ -22,20 +24,41 @@ def test_homepage_renders():
     assert "GKE Search" in r.text or "Semantic" in r.text
 
 
+def test_homepage_not_modified_with_matching_etag():
+    client = TestClient(svc.app)
+    etag = client.get("/").headers["etag"]
+    r = client.get("/", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+
+
 def test_search_returns_list_with_title_and_score(monkeypatch):
-    # mock OpenSearch: knn returns two hits with title + embedding so re-rank can run
-    dummy_embedding = [0.1] * 384
+    # mock OpenSearch: knn hits come back like production's, no _source, title + tokens from doc values
+    dummy_embedding = np.full(384, 0.1, dtype=np.float32)
 
-    def fake_post(url, json, timeout):
-        return DummyResponse(
-            hits=[
-                {"_source": {"title": "Black Leather Jacket for Men", "embedding": dummy_embedding}},
-                {"_source": {"title": "Blue Summer Dress", "embedding": dummy_embedding}},
-            ]
-        )
+    async def fake_search(body, params=None, timeout=10):
+        hits = [
+            {
+                "_id": "1",
+                "_score": 0.9,
+                "fields": {
+                    "title.raw": ["Black Leather Jacket for Men"],
+                    "title_tokens": ["black", "for", "jacket", "leather", "men"],
+                },
+            },
+            {
+                "_id": "2",
+                "_score": 0.8,
+                "fields": {
+                    "title.raw": ["Blue Summer Dress"],
+                    "title_tokens": ["blue", "dress", "summer"],
+                },
+            },
+        ]
+        return DummyResponse(hits=hits)
 
     monkeypatch.setattr(svc, "embed_cached", lambda q: dummy_embedding)
-    monkeypatch.setattr(svc, "_run_search", lambda url, body, timeout=10: fake_post(url, body, timeout))
+    monkeypatch.setattr(svc, "_run_search", fake_search)
 
     client = TestClient(svc.app)
     r = client.get("/search", params={"q": "black leather jacket", "k": 2})
@@ -51,3 +74,128 @@ def test_search_requires_query():
     client = TestClient(svc.app)
     r = client.get("/search", params={"q": "   "})
     assert r.status_code == 400
+
+
+def test_search_falls_back_to_match_when_knn_errors(monkeypatch):
+    # knn search errors, the title match sent after it still has hits
+    dummy_embedding = np.full(384, 0.1, dtype=np.float32)
+    sent = []
+
+    async def fake_search(body, params=None, timeout=10):
+        sent.append(body)
+        if "knn" in body["query"]:
+            return DummyResponse(status_code=400, text='{"error": {"type": "parsing_exception"}, "status": 400}')
+        hit = {"_id": "7", "_score": 3.0, "_source": {"embedding": dummy_embedding.tolist()}, "fields": {"title.raw": ["Red Wool Scarf"]}}
+        return DummyResponse(hits=[hit])
+
+    monkeypatch.setattr(svc, "embed_cached", lambda q: dummy_embedding)
+    monkeypatch.setattr(svc, "_run_search", fake_search)
+
+    client = TestClient(svc.app)
+    r = client.get("/search", params={"q": "scarf", "k": 3})
+    assert r.status_code == 200
+    assert [x["title"] for x in r.json()] == ["Red Wool Scarf"]
+    assert [list(body["query"]) for body in sent] == [["knn"], ["match"]]
+
+
+def test_search_fetches_titles_missing_from_doc_values(monkeypatch):
+    # index built before title.raw existed: knn hits have neither fields nor _source, titles come from one _mget
+    async def fake_search(body, params=None, timeout=10):
+        hits = [{"_index": "products", "_id": "a", "_score": 0.9}, {"_index": "products", "_id": "b", "_score": 0.5}]
+        return DummyResponse(hits=hits)
+
+    class MgetResponse:
+        status_code = 200
+        text = ""
+        content = orjson.dumps({"docs": [
+            {"_index": "products", "_id": "a", "found": True, "_source": {"title": "Black Leather Jacket"}},
+            {"_index": "products", "_id": "b", "found": True, "_source": {"title": "Blue Summer Dress"}},
+        ]})
+
+    async def fake_mget(docs, timeout=10):
+        assert [d["_id"] for d in docs] == ["a", "b"]
+        return MgetResponse()
+
+    monkeypatch.setattr(svc, "embed_cached", lambda q: np.full(384, 0.1, dtype=np.float32))
+    monkeypatch.setattr(svc, "_run_search", fake_search)
+    monkeypatch.setattr(svc, "_run_mget", fake_mget)
+
+    client = TestClient(svc.app)
+    r = client.get("/search", params={"q": "black jacket", "k": 2})
+    assert r.status_code == 200
+    assert [x["title"] for x in r.json()] == ["Black Leather Jacket", "Blue Summer Dress"]
+
+
+def test_top_k_breaks_ties_at_the_boundary_by_position():
+    # indices 1..5 tie for second place; k=3 has to keep the first two of them in order, like a stable sort
+    scores = np.array([0.9, 0.5, 0.5, 0.5, 0.5, 0.5, 0.1])
+    for k in range(1, len(scores) + 1):
+        assert svc._top_k_indices(scores, k).tolist() == sorted(range(len(scores)), key=lambda i: -scores[i])[:k]
+    assert svc._top_k_indices(scores, 3).tolist() == [0, 1, 2]
+
+
+def test_health_is_not_access_logged():
+    client = TestClient(svc.app)
+    r = client.get("/health")
+    assert r.status_code == 200
+    assert r.json() == {"ok": True}
+
+    # same args shape uvicorn's access logger uses: (client, method, path, http version, status)
+    def access_record(path):
+        args = ("1.2.3.4:5", "GET", path, "1.1", 200)
+        return logging.LogRecord("uvicorn.access", logging.INFO, "", 0, '%s - "%s %s HTTP/%s" %d', args, None)
+
+    f = svc._SkipHealthAccessLog()
+    assert not f.filter(access_record("/health"))
+    assert f.filter(access_record("/search?q=coat"))
+
+
+def test_hybrid_search_returns_opensearch_order(monkeypatch):
+    # hybrid mode: OpenSearch already fused and ranked, we just pass the top k through with display scores
+    class HybridResponse:
+        status_code = 200
+        text = ""
+        content = orjson.dumps({"hits": {"hits": [
+            {"_score": 0.9, "fields": {"title.raw": ["Navy Wool Coat"]}},
+            {"_score": 0.3, "fields": {"title.raw": ["Grey Wool Coat"]}},
+        ]}})
+
+    async def fake_search(body, params=None, timeout=10):
+        # only the hybrid query goes out; the re-rank path's knn search would fail these asserts
+        assert params == {"search_pipeline": svc.HYBRID_PIPELINE}
+        assert body["size"] == 2 and "hybrid" in body["query"]
+        return HybridResponse()
+
+    monkeypatch.setattr(svc, "HYBRID_SEARCH", True)
+    monkeypatch.setattr(svc, "embed_cached", lambda q: np.full(384, 0.1, dtype=np.float32))
+    monkeypatch.setattr(svc, "_run_search", fake_search)
+
+    client = TestClient(svc.app)
+    r = client.get("/search", params={"q": "wool coat", "k": 2})
+    assert r.status_code == 200
+    assert r.json() == [{"title": "Navy Wool Coat", "score": 1.0}, {"title": "Grey Wool Coat", "score": 0.0}]
+
+
+def test_embed_batcher_coalesces_concurrent_requests():
+    # the first call holds the worker, so the ones that arrive meanwhile should go out as one batch
+    import threading
+    import time
+
+    batch_sizes = []
+
+    def fake_encode(texts):
+        batch_sizes.append(len(texts))
+        time.sleep(0.05)
+        return np.array([[float(len(t))] for t in texts], dtype=np.float32)
+
+    batcher = svc.EmbedBatcher(fake_encode, max_batch=32)
+    out = {}
+    threads = [threading.Thread(target=lambda n=n: out.__setitem__(n, batcher.submit("x" * n))) for n in range(1, 7)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert {n: float(v[0]) for n, v in out.items()} == {n: float(n) for n in range(1, 7)}
+    assert sum(batch_sizes) == 6
+    assert len(batch_sizes) < 6
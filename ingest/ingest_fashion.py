@@ -1,9 +1,16 @@
 import gzip
-import json
+import hashlib
 import os
+import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from sentence_transformers import SentenceTransformer
+from urllib3.util import Retry
 
 
 # =============================================================================
@@ -18,14 +25,79 @@ DIM = 384
 # HNSW params: bigger ef_construction = better graph but slower to build. m = links per node.
 HNSW_EF_CONSTRUCTION = 200
 HNSW_M = 24
-# how many candidates to look at when searching (more = better recall, slower)
-HNSW_EF_SEARCH = 200
+# no ef_search: the lucene engine ignores knn.algo_param.ef_search and searches with ef = k
+# (per-query method_parameters.ef_search only arrives in k-NN 2.16; compose runs 2.12)
+
+# same tokenizer as search_service, so the stored title tokens match what the re-rank would compute
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# search pipeline for the API's HYBRID_SEARCH mode: min-max each sub-query's scores, then weight knn vs title match.
+# only created with HYBRID_SEARCH=1 (needs the neural-search plugin), same opt-in as the API
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "0") == "1"
+HYBRID_PIPELINE = os.getenv("HYBRID_PIPELINE", "hybrid-search")
+HYBRID_WEIGHTS = [0.4, 0.6]
+
+DATA_PATH = "data/meta_Amazon_Fashion.jsonl.gz"
+# re-running with the same mapping + encoder + data file skips the ingest once a previous run finished;
+# FORCE_REINDEX=1 rebuilds anyway
+FORCE_REINDEX = os.getenv("FORCE_REINDEX", "0") == "1"
 
 BATCH_SIZE = 200
 EMBED_BATCH_SIZE = 32
-
-model = SentenceTransformer("all-MiniLM-L6-v2")
+# INGEST_CACHE_DIR: save each batch's int8 vectors as a .npy so a re-run (new mapping, lost index) skips the encoder.
+# files go in a subdir keyed by encoder + data file + batching, so changing any of them starts a fresh cache
+INGEST_CACHE_DIR = os.getenv("INGEST_CACHE_DIR", "")
+# gzip level for the _bulk body (0 = send it uncompressed). level 1 gets most of the size win for very little CPU
+BULK_GZIP_LEVEL = int(os.getenv("BULK_GZIP_LEVEL", "1"))
+# bulk requests allowed in flight at once (each on its own pooled connection) while the next batch is encoded
+BULK_IN_FLIGHT = int(os.getenv("BULK_IN_FLIGHT", "2"))
+
+# INGEST_ONNX_INT8=1: encode with a dynamically int8-quantized ONNX export instead of fp32 torch (2-4x on CPU).
+# exported once into INGEST_ONNX_DIR and reused. needs sentence-transformers >= 3.2 with the onnx extra
+INGEST_ONNX_INT8 = os.getenv("INGEST_ONNX_INT8", "0") == "1"
+INGEST_ONNX_DIR = os.getenv("INGEST_ONNX_DIR", "onnx-ingest")
+INGEST_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+
+def load_model():
+    """sentence-transformers by default (fp16 on a GPU, fp32 on CPU), or the int8 ONNX model (exported + quantized on first run)"""
+    if not INGEST_ONNX_INT8:
+        st = SentenceTransformer(MODEL_NAME)
+        if st.device.type == "cuda":
+            # fp16 weights + activations on GPU: half the memory traffic and tensor-core matmuls.
+            # the vectors get quantized to int8 before indexing anyway (quantize_int8 casts back to float32 first)
+            st.half()
+        return st
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    if not os.path.exists(os.path.join(INGEST_ONNX_DIR, INGEST_ONNX_FILE)):
+        print(f"Exporting int8 ONNX model to {INGEST_ONNX_DIR} (one-time)...")
+        fp32 = SentenceTransformer(MODEL_NAME, backend="onnx")
+        fp32.save_pretrained(INGEST_ONNX_DIR)
+        # avx512_vnni: int8 MatMuls on the VNNI dot-product instructions
+        export_dynamic_quantized_onnx_model(fp32, "avx512_vnni", INGEST_ONNX_DIR)
+    return SentenceTransformer(INGEST_ONNX_DIR, backend="onnx", model_kwargs={"file_name": INGEST_ONNX_FILE})
+
+
+def encoder_id():
+    """which encoder made the vectors: onnx int8 / torch fp16 (GPU) / torch fp32. part of the index + cache keys"""
+    return "onnx-int8" if INGEST_ONNX_INT8 else ("torch-fp16" if model.device.type == "cuda" else "torch-fp32")
+
+
+model = load_model()
 session = requests.Session()
+# keep-alive pool + retry on gateway errors. urllib3 doesn't retry POST by default, so _bulk is never sent twice.
+# raise_on_status=False: once retries run out, hand back the last 5xx response instead of raising RetryError,
+# so the status checks below (and raise_for_status) still see it
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(4, BULK_IN_FLIGHT),
+    max_retries=Retry(total=2, backoff_factor=0.05, status_forcelist=[502, 503, 504], raise_on_status=False),
+)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
 
 
 # =============================================================================
@@ -33,16 +105,18 @@ session = requests.Session()
 # =============================================================================
 
 def wait_for_opensearch(timeout_s=120):
-    """poll until OpenSearch is up or we hit the timeout"""
+    """poll until OpenSearch is up or we hit the timeout. HEAD, backing off from 100ms to 2s so a fresh container is noticed quickly"""
     start = time.time()
+    wait = 0.1
     while time.time() - start < timeout_s:
         try:
-            r = session.get(f"{OPENSEARCH_URL}", timeout=5)
+            r = session.head(f"{OPENSEARCH_URL}", timeout=1)
             if r.status_code == 200:
                 return True
         except requests.RequestException:
             pass
-        time.sleep(2)
+        time.sleep(wait)
+        wait = min(wait * 1.7, 2.0)
     return False
 
 
@@ -50,27 +124,32 @@ def wait_for_opensearch(timeout_s=120):
 # index (recreate with HNSW + cosine)
 # =============================================================================
 
-def recreate_index():
-    """drop the index if it exists and create it with HNSW knn_vector mapping (cosine space)"""
-    session.delete(f"{OPENSEARCH_URL}/{INDEX_NAME}", timeout=30)
-
-    mapping = {
+def index_mapping():
+    """settings + HNSW knn_vector mapping (int8, cosine on unit vectors)"""
+    return {
         "settings": {
             "index": {
                 "knn": True,
-                "knn.algo_param.ef_search": HNSW_EF_SEARCH
+                # search each shard's segments in parallel instead of one after another (needs OpenSearch 2.12+)
+                "search.concurrent_segment_search.enabled": True
             }
         },
         "mappings": {
             "properties": {
-                "title": {"type": "text"},
+                # title.raw is the exact title as a doc value, so search can skip _source entirely
+                "title": {"type": "text", "fields": {"raw": {"type": "keyword", "ignore_above": 1024}}},
+                "title_tokens": {"type": "keyword"},
                 "embedding": {
                     "type": "knn_vector",
                     "dimension": DIM,
+                    # int8 vectors: 4x smaller graph and working set than float. byte vectors need the lucene engine
+                    "data_type": "byte",
                     "method": {
                         "name": "hnsw",
+                        # cosinesimil, not innerproduct: lucene byte vectors only take innerproduct from k-NN 2.13,
+                        # and the compose stack runs 2.12. on unit vectors the ranking is the same
                         "space_type": "cosinesimil",
-                        "engine": "nmslib",
+                        "engine": "lucene",
                         "parameters": {
                             "ef_construction": HNSW_EF_CONSTRUCTION,
                             "m": HNSW_M
@@ -81,18 +160,94 @@ def recreate_index():
         }
     }
 
+
+def index_fingerprint(mapping):
+    """hash of the mapping, the encoder (model, precision, doc prefix) and the data file's size/mtime. kept in the index
+    _meta so a re-run can tell nothing changed; switching encoder rebuilds, since the stored vectors would differ"""
+    st = os.stat(DATA_PATH)
+    raw = orjson.dumps(
+        {
+            "mapping": mapping,
+            "encoder": [MODEL_NAME, encoder_id(), DOC_EMBED_PREFIX],
+            "data": [DATA_PATH, st.st_size, int(st.st_mtime)],
+        },
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def index_is_current(fingerprint):
+    """true if the index exists, was built from the same mapping + encoder + data, and the last ingest into it finished"""
+    r = session.get(f"{OPENSEARCH_URL}/{INDEX_NAME}/_mapping", timeout=30)
+    if r.status_code != 200:
+        return False
+    meta = orjson.loads(r.content).get(INDEX_NAME, {}).get("mappings", {}).get("_meta", {})
+    return meta.get("fingerprint") == fingerprint and meta.get("ingest_complete") is True
+
+
+def recreate_index(mapping, fingerprint):
+    """drop the index if it exists and create it, marked as not fully ingested yet"""
+    session.delete(f"{OPENSEARCH_URL}/{INDEX_NAME}", timeout=30)
+
+    body = dict(mapping, mappings=dict(mapping["mappings"], _meta={"fingerprint": fingerprint, "ingest_complete": False}))
     r = session.put(
         f"{OPENSEARCH_URL}/{INDEX_NAME}",
-        json=mapping,
+        json=body,
+        timeout=30
+    )
+    r.raise_for_status()
+
+
+def mark_ingest_complete(fingerprint):
+    """flag the index as fully built so the next run with the same mapping + encoder + data can skip"""
+    r = session.put(
+        f"{OPENSEARCH_URL}/{INDEX_NAME}/_mapping",
+        json={"_meta": {"fingerprint": fingerprint, "ingest_complete": True}},
         timeout=30
     )
     r.raise_for_status()
 
 
+def create_hybrid_pipeline():
+    """create (or overwrite) the normalization pipeline the hybrid query runs through. best effort: without it the API
+    just falls back to its own re-rank, so a cluster without neural-search can still ingest"""
+    pipeline = {
+        "description": "min-max normalize knn + title match, weighted mean",
+        "phase_results_processors": [
+            {
+                "normalization-processor": {
+                    "normalization": {"technique": "min_max"},
+                    "combination": {
+                        "technique": "arithmetic_mean",
+                        "parameters": {"weights": HYBRID_WEIGHTS}
+                    }
+                }
+            }
+        ]
+    }
+    try:
+        r = session.put(f"{OPENSEARCH_URL}/_search/pipeline/{HYBRID_PIPELINE}", json=pipeline, timeout=30)
+    except requests.RequestException as e:
+        print(f"WARNING: couldn't create search pipeline '{HYBRID_PIPELINE}': {e}")
+        return
+    if r.status_code >= 400:
+        print(f"WARNING: couldn't create search pipeline '{HYBRID_PIPELINE}' ({r.status_code}): {r.text[:200]}")
+        return
+    print(f"Search pipeline '{HYBRID_PIPELINE}' created.")
+
+
 # same prefix as search_service so query and doc embeddings line up
 DOC_EMBED_PREFIX = "Clothing, fashion product or accessory: "
 
 
+def quantize_int8(embs):
+    """unit vectors scaled to int8. cosine on these ranks the same as cosine on the floats (search_service does the same)"""
+    embs = np.asarray(embs, dtype=np.float32)
+    norms = np.linalg.norm(embs, axis=-1, keepdims=True)
+    embs = embs / np.clip(norms, 1e-12, None)
+    return np.clip(np.round(embs * 127.0), -128, 127).astype(np.int8)
+
+
 def build_text(doc):
     parts = []
     if doc.get("title"):
@@ -116,26 +271,36 @@ def build_text(doc):
 # bulk index
 # =============================================================================
 
+BULK_ACTION = orjson.dumps({"index": {"_index": INDEX_NAME}})
+
+
 def bulk_index(items, embs):
-    """send one bulk request: each item gets title + embedding, NDJSON with trailing newline"""
+    """send one bulk request: each item gets title + embedding, NDJSON with trailing newline.
+    embs is the int8 numpy matrix; orjson writes the rows directly, no tolist()"""
     lines = []
     for item, emb in zip(items, embs):
-        lines.append(json.dumps({"index": {"_index": INDEX_NAME}}))
-        lines.append(json.dumps({
+        lines.append(BULK_ACTION)
+        title = item["title"] or ""
+        lines.append(orjson.dumps({
             "title": item["title"],
+            "title_tokens": sorted(set(TOKEN_RE.findall(title.lower()))),
             "embedding": emb
-        }))
-    payload = "\n".join(lines) + "\n"
+        }, option=orjson.OPT_SERIALIZE_NUMPY))
+    payload = b"\n".join(lines) + b"\n"
+    headers = {"Content-Type": "application/json"}
+    if BULK_GZIP_LEVEL:
+        payload = gzip.compress(payload, compresslevel=BULK_GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
 
     r = session.post(
         f"{OPENSEARCH_URL}/_bulk",
-        headers={"Content-Type": "application/json"},
+        headers=headers,
         data=payload,
         timeout=120
     )
     r.raise_for_status()
 
-    resp = r.json()
+    resp = orjson.loads(r.content)
     if resp.get("errors"):
         for it in resp.get("items", []):
             idx = it.get("index", {})
@@ -144,25 +309,74 @@ def bulk_index(items, embs):
         raise RuntimeError("Bulk ingest had errors, but couldn't extract example.")
 
 
+def embed_cache_dir():
+    """cache subdir for this encoder (onnx int8 / torch fp16 / torch fp32), data file (size + mtime), batch size and doc prefix"""
+    st = os.stat(DATA_PATH)
+    key = f"{MODEL_NAME}|{encoder_id()}|{DATA_PATH}|{st.st_size}|{int(st.st_mtime)}|{BATCH_SIZE}|{DOC_EMBED_PREFIX}"
+    return os.path.join(INGEST_CACHE_DIR, hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest())
+
+
+def embed_items(items, batch_no, cache_dir=None):
+    """encode a batch of docs and quantize to the int8 vectors the index stores (or load them from cache_dir)"""
+    path = os.path.join(cache_dir, f"embs_{batch_no:06d}.npy") if cache_dir else None
+    if path and os.path.exists(path):
+        embs = np.load(path)
+        if len(embs) == len(items):
+            return embs
+    texts = [x["text"] for x in items]
+    embs = quantize_int8(model.encode(texts, batch_size=EMBED_BATCH_SIZE, show_progress_bar=False))
+    if path:
+        np.save(path, embs)
+    return embs
+
+
+def wait_for_upload(upload, indexed):
+    """block on one in-flight bulk request (re-raises its error), print progress, return the new indexed count"""
+    future, n_docs, note = upload
+    future.result()
+    indexed += n_docs
+    print(f"Indexed {indexed} docs ({note})")
+    return indexed
+
+
 # =============================================================================
 # main
 # =============================================================================
 
 def main():
-    """wait for OpenSearch, recreate index, stream the gzipped jsonl and index in batches"""
+    """wait for OpenSearch, recreate index (unless it's already current), stream the gzipped jsonl and index in batches"""
     if not wait_for_opensearch():
         raise RuntimeError("OpenSearch never became ready (timeout).")
 
+    mapping = index_mapping()
+    fingerprint = index_fingerprint(mapping)
+    if not FORCE_REINDEX and index_is_current(fingerprint):
+        print("Index already built from this mapping + data, skipping ingest (FORCE_REINDEX=1 to rebuild).")
+        return
+
     print("Recreating index with knn_vector mapping...")
-    recreate_index()
+    recreate_index(mapping, fingerprint)
     print("Index created.")
+    if HYBRID_SEARCH:
+        create_hybrid_pipeline()
+
+    cache_dir = embed_cache_dir() if INGEST_CACHE_DIR else None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        print(f"Embedding cache: {cache_dir}")
 
     buffer = []
+    batch_no = 0
     indexed = 0
+    pending = deque()
 
-    with gzip.open("data/meta_Amazon_Fashion.jsonl.gz", "rt", encoding="utf-8") as f:
+    # keep encoding while up to BULK_IN_FLIGHT bulk requests run, so at most BULK_IN_FLIGHT + 1 batches are in memory.
+    # uploads are waited on oldest first, so progress still prints in file order
+    with ThreadPoolExecutor(max_workers=BULK_IN_FLIGHT) as uploader, \
+            gzip.open(DATA_PATH, "rb") as f:
         for i, line in enumerate(f, start=1):
-            doc = json.loads(line)
+            # raw utf-8 bytes straight into orjson, no text-mode decode first
+            doc = orjson.loads(line)
             text = build_text(doc)
             if not text:
                 continue
@@ -170,23 +384,20 @@ def main():
             buffer.append({"title": doc.get("title"), "text": text})
 
             if len(buffer) >= BATCH_SIZE:
-                texts = [x["text"] for x in buffer]
-                embs = model.encode(texts, batch_size=EMBED_BATCH_SIZE, show_progress_bar=False)
-                embs = [e.tolist() for e in embs]
-
-                bulk_index(buffer, embs)
-                indexed += len(buffer)
-                print(f"Indexed {indexed} docs (read line {i})")
+                embs = embed_items(buffer, batch_no, cache_dir)
+                batch_no += 1
+                while len(pending) >= BULK_IN_FLIGHT:
+                    indexed = wait_for_upload(pending.popleft(), indexed)
+                pending.append((uploader.submit(bulk_index, buffer, embs), len(buffer), f"read line {i}"))
                 buffer = []
 
-    if buffer:
-        texts = [x["text"] for x in buffer]
-        embs = model.encode(texts, batch_size=EMBED_BATCH_SIZE, show_progress_bar=False)
-        embs = [e.tolist() for e in embs]
-        bulk_index(buffer, embs)
-        indexed += len(buffer)
-        print(f"Indexed {indexed} docs (final flush)")
+        if buffer:
+            embs = embed_items(buffer, batch_no, cache_dir)
+            pending.append((uploader.submit(bulk_index, buffer, embs), len(buffer), "final flush"))
+        while pending:
+            indexed = wait_for_upload(pending.popleft(), indexed)
 
+    mark_ingest_complete(fingerprint)
     print("Done.")
 
 